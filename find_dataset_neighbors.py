@@ -63,7 +63,7 @@ def main(input_dir, output_dir, features_path, data, max_size, cache, workers, b
         with torch.no_grad():
             for dataset_iter in tqdm(dataset_iterator):
                 images = dataset_iter[0]
-                images = images.to('cuda').to(torch.float32)
+                images = images.to('cuda', non_blocking=True).to(torch.float32)
                 local_features = feature_extractor((pad_image(images) + 1) / 2. ).cpu()
                 features.append(local_features)
         features = np.concatenate(features)
@@ -101,4 +101,55 @@ def get_hat_patch_mask(patch_mask, crop_size, hat_crop_size, same_for_all_batch=
     hat_patch_mask = torch.clone(patch_mask)
     hat_patch_mask.view(-1)[patch_indices] = expanded_hat_mask
     hat_patch_mask = hat_patch_mask.reshape(patch_mask.shape)
-    return hat_patch_mask
\ No newline at end of file
+    return hat_patch_mask
+
+def get_box_mask_np(image_shape, survival_probability, rng, out=None):
+    """NumPy version of get_box_mask for CPU data loading, drawing box positions from a np.random.Generator.
+        Args:
+            image_shape: (batch_size, num_channels, height, width)
+            survival_probability: probability of a pixel being unmasked
+            rng: np.random.Generator used to place the boxes
+            out: optional float32 or bool array of shape image_shape to write the mask into
+        Returns:
+            mask: (batch_size, num_channels, height, width)
+    """
+    batch_size, _, height, width = image_shape
+    box_height = int(np.ceil((1 - survival_probability) * height))
+    box_width = int(np.ceil((1 - survival_probability) * width))
+    box_start_row = rng.integers(0, height, size=batch_size)
+    box_start_col = rng.integers(0, width, size=batch_size)
+
+    mask = np.empty(image_shape, dtype=np.float32) if out is None else out
+    mask.fill(1.0)
+    for i in range(batch_size):
+        mask[i, :, box_start_row[i]:box_start_row[i] + box_height, box_start_col[i]:box_start_col[i] + box_width] = 0.0
+    return mask
+
+
+def get_patch_mask_np(image_shape, crop_size, rng, out=None):
+    """NumPy version of get_patch_mask for CPU data loading, drawing patch positions from a np.random.Generator.
+        Args:
+            image_shape: (batch_size, num_channels, height, width)
+            crop_size: side length of the square patch that is kept
+            rng: np.random.Generator used to place the patches
+            out: optional float32 or bool array of shape image_shape to write the mask into
+        Returns:
+            mask: (batch_size, num_channels, height, width)
+    """
+    batch_size, _, height, width = image_shape
+    box_start_row = rng.integers(0, height - crop_size, size=batch_size)
+    box_start_col = rng.integers(0, width - crop_size, size=batch_size)
+
+    mask = np.empty(image_shape, dtype=np.float32) if out is None else out
+    mask.fill(0.0)
+    for i in range(batch_size):
+        mask[i, :, box_start_row[i]:box_start_row[i] + crop_size, box_start_col[i]:box_start_col[i] + crop_size] = 1.0
+    return mask
+
+
+def get_hat_patch_mask_np(patch_mask, crop_size, hat_crop_size, rng):
+    """NumPy version of get_hat_patch_mask: keeps a random hat_crop_size patch inside each patch of patch_mask."""
+    hat_mask = get_patch_mask_np((patch_mask.shape[0], patch_mask.shape[1], crop_size, crop_size), hat_crop_size, rng)
+    hat_patch_mask = patch_mask.copy()
+    hat_patch_mask[patch_mask == 1] = hat_mask.reshape(-1)
+    return hat_patch_mask
@@ -83,7 +83,7 @@ def parse_int_list(s):
               default=1.007, show_default=True)
 # --- Robust diffusion ----
 @click.option('--corruption_fraction', help='Fraction of corrupted examples',
-              metavar='FLOAT', default=0., show_default=True)
+              metavar='FLOAT', default=1., show_default=True)
 @click.option('--corruption_probability', help='Probability of corrupting a single pixel from the dataset',
               metavar='FLOAT', default=0.4, show_default=True)
 @click.option('--delta_probability', help='Probability of corrupting a pixel that survived', metavar='FLOAT',
@@ -101,9 +101,13 @@ def parse_int_list(s):
               show_default=True)
 @click.option('--ls', help='Loss scaling', metavar='FLOAT', type=click.FloatRange(min=0), default=1, show_default=True)
 @click.option('--bench', help='Enable cuDNN benchmarking', metavar='BOOL', type=bool, default=True, show_default=True)
+@click.option('--channels_last', help='Use channels_last (NHWC) batches and weights', metavar='BOOL', type=bool,
+              default=False, show_default=True)
 @click.option('--cache', help='Cache dataset in CPU memory', metavar='BOOL', type=bool, default=True, show_default=True)
 @click.option('--workers', help='DataLoader worker processes', metavar='INT', type=click.IntRange(min=1), default=1,
               show_default=True)
+@click.option('--decode_threads', help='Image decoding threads per DataLoader worker, 0 = serial', metavar='INT',
+              type=click.IntRange(min=0), default=0, show_default=True)
 # I/O-related.
 @click.option('--desc', help='String to include in result dir name', metavar='STR', type=str)
 @click.option('--nosubdir', help='Do not create a subdirectory for results', is_flag=True)
@@ -140,6 +144,8 @@ def main(**kwargs):
 	c.update(max_grad_norm=opts.max_grad_norm)
 	c.dataset_kwargs = dnnlib.EasyDict(class_name='training.dataset.ImageFolderDataset', path=opts.data,
 	                                   use_labels=opts.cond, xflip=opts.xflip, cache=opts.cache,
+	                                   decode_threads=opts.decode_threads,
+	                                   corruption_fraction=opts.corruption_fraction,
 	                                   corruption_probability=opts.corruption_probability,
 	                                   delta_probability=opts.delta_probability, mask_full_rgb=opts.mask_full_rgb,
 	                                   corruption_pattern=opts.corruption_pattern)
@@ -220,7 +226,7 @@ def main(**kwargs):
 	c.total_kimg = max(int(opts.duration * 1000), 1)
 	c.ema_halflife_kimg = int(opts.ema * 1000)
 	c.update(batch_size=opts.batch, batch_gpu=opts.batch_gpu)
-	c.update(loss_scaling=opts.ls, cudnn_benchmark=opts.bench)
+	c.update(loss_scaling=opts.ls, cudnn_benchmark=opts.bench, channels_last=opts.channels_last)
 	c.update(kimg_per_tick=opts.tick, snapshot_ticks=opts.snap, state_dump_ticks=opts.dump)
 
 	# Random seed.
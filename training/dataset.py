@@ -8,13 +8,23 @@
 """Streaming images and labels from datasets created with dataset_tool.py."""
 
 import os
+import io
+import collections
+import concurrent.futures
+import functools
+import weakref
+import mmap
+import shutil
+import struct
+import zlib
 import numpy as np
 import zipfile
 import PIL.Image
 import json
+import psutil
 import torch
 import dnnlib
-from torch_utils.ambient_diffusion import get_box_mask, get_patch_mask, get_hat_patch_mask
+from torch_utils.ambient_diffusion import get_box_mask_np, get_patch_mask_np, get_hat_patch_mask_np
 from dnnlib.util import create_down_up_matrix, sample_ratio
 
 try:
@@ -22,6 +32,82 @@ try:
 except ImportError:
     pyspng = None
 
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Fused x-flip + [0, 255] -> [-1, 1] normalization, writing a contiguous float32 CHW image in a single pass.
+# Not parallel: DataLoader workers already run one sample per process.
+_NORM_SCALE = np.float32(1 / 127.5)
+_NORM_OFFSET = np.float32(-1)
+
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True)
+    def _flip_normalize(image, out, flip):
+        # The flip test is hoisted out of the row loops so that LLVM can vectorize the uint8 -> float32 widening
+        # and the multiply-add (vpmovzxbd + vcvtdq2ps + vfmadd on AVX2).
+        num_channels, height, width = image.shape
+        for c in range(num_channels):
+            for h in range(height):
+                if flip:
+                    for w in range(width):
+                        out[c, h, w] = image[c, h, width - 1 - w] * _NORM_SCALE + _NORM_OFFSET
+                else:
+                    for w in range(width):
+                        out[c, h, w] = image[c, h, w] * _NORM_SCALE + _NORM_OFFSET
+else:
+    def _flip_normalize(image, out, flip):
+        if flip:
+            image = image[:, :, ::-1]
+        np.multiply(image, _NORM_SCALE, out=out)
+        out += _NORM_OFFSET
+
+
+class _BufferPool:
+    """Per-process free list of numpy buffers, keyed by shape and dtype.
+
+    get() returns a fresh view of a pooled buffer. The buffer goes back to the free list once that view object
+    is garbage collected, even if numpy views derived from it are still alive. It is therefore only used by
+    Dataset.__getitems__ inside DataLoader workers, where collate_fn consumes the batch immediately.
+    """
+
+    def __init__(self):
+        self._free = collections.defaultdict(list)
+
+    def get(self, shape, dtype):
+        free = self._free[(tuple(shape), np.dtype(dtype))]
+        buf = free.pop() if free else np.empty(shape, dtype=dtype)
+        view = buf[...]
+        weakref.finalize(view, free.append, buf)
+        return view
+
+
+def collate_channels_last(batch):
+    """default_collate variant that stacks CHW images and masks straight into NCHW tensors with channels_last
+    (NHWC) strides, so the training step gets the layout cuDNN prefers without a per-step permute + copy."""
+    fields = []
+    for field in zip(*batch):
+        if isinstance(field[0], np.ndarray) and field[0].ndim == 3:
+            num_channels, height, width = field[0].shape
+            out = np.empty((len(field), height, width, num_channels), dtype=field[0].dtype)
+            for i, item in enumerate(field):
+                np.copyto(out[i], item.transpose(1, 2, 0))  # one strided pass per sample, no intermediate stack
+            fields.append(torch.from_numpy(out).permute(0, 3, 1, 2))
+        else:
+            fields.append(torch.utils.data.default_collate(list(field)))
+    return fields
+
+
+# Bump when the layout of the cached zip index (<archive>.fnames.json) changes.
+_ZIP_INDEX_VERSION = 2
+
 
 # Abstract base class for datasets.
 class Dataset(torch.utils.data.Dataset):
@@ -31,10 +117,12 @@ class Dataset(torch.utils.data.Dataset):
                  max_size=None,  # Artificially limit the size of the dataset. None = no limit.
                  use_labels=False,  # Enable conditioning labels? False = label dimension is zero.
                  xflip=False,  # Artificially double the size of the dataset via x-flips.
-                 random_seed=0,  # Random seed to use when applying max_size.
+                 random_seed=0,  # Random seed to use when applying max_size and selecting corrupted samples.
                  cache: bool = False,  # Cache images in CPU memory?
+                 cache_size=None,  # Max images to cache per rank, None = this rank's share of half the available RAM.
+                 decode_threads=0,  # Threads decoding the images of a batch within each worker, 0 = serial.
 
-                 corruption_fraction: float = 0.,  # fraction of samples corrupted
+                 corruption_fraction: float = 1.,  # fraction of samples corrupted
                  corruption_probability=0.,  # Probability to corrupt a single image.
                  delta_probability=0.,  # Probability to corrupt further an already corrupted image.
                  mask_full_rgb=False,
@@ -52,7 +140,15 @@ class Dataset(torch.utils.data.Dataset):
         self._raw_shape = list(raw_shape)
         self._use_labels = use_labels
         self._cache = cache
-        self._cached_images = dict()  # {raw_idx: np.ndarray, ...}
+        self._cached_images = None  # Tensor[slot, C, H, W] in shared memory, visible to all DataLoader workers.
+        self._cached_flags = None  # Tensor[slot], True once the corresponding image has been decoded.
+        self._cache_slot = None  # ndarray[raw_idx] => slot in the shared cache, -1 for images outside max_size.
+        self._cache_size = None  # LRU budget of this rank, split across its DataLoader workers.
+        self._lru_loader = None  # functools.lru_cache around _load_raw_image, created lazily in each process.
+        self._decode_threads = decode_threads
+        self._local_pid = None  # Process that owns the per-process state below, created lazily.
+        self._buffer_pool = None  # _BufferPool of the current process.
+        self._decode_executor = None  # ThreadPoolExecutor of the current process.
         self._raw_labels = None
         self._label_shape = None
 
@@ -65,18 +161,60 @@ class Dataset(torch.utils.data.Dataset):
         self.ratios = ratios
         self.normalize = normalize
 
+        # Resolve the corruption pattern once instead of comparing strings for every sample.
+        self._apply_corruption = {"dust": self._apply_dust,
+                                  "box": self._apply_box,
+                                  "fixed_box": self._apply_fixed_box,
+                                  "keep_patch": self._apply_keep_patch}[corruption_pattern]
+
+        # Patch sizes only depend on the corruption parameters, so compute them once.
+        self._patch_size, self._hat_patch_size = None, None
+        if corruption_pattern == "fixed_box":
+            self._patch_size = int(self.corruption_probability * self._raw_shape[-2])
+        elif corruption_pattern == "keep_patch":
+            self._patch_size = int((1 - self.corruption_probability) * self._raw_shape[-2])
+            self._hat_patch_size = int((1 - self.delta_probability) * self._patch_size)
+
         # Apply max_size -- limit the dataset size .
         # TODO: place to implement coreset selection algorithm -- use my coreset repository
+        seed = 0 if random_seed is None else random_seed % (1 << 31)  # e.g. train_text_to_image.py without --seed
         self._raw_idx = np.arange(self._raw_shape[0], dtype=np.int64)
         if (max_size is not None) and (self._raw_idx.size > max_size):
-            np.random.RandomState(random_seed % (1 << 31)).shuffle(self._raw_idx)
+            np.random.RandomState(seed).shuffle(self._raw_idx)
             self._raw_idx = np.sort(self._raw_idx[:max_size])
 
+        # Size the cache for the images that survive max_size, not the whole archive.
+        if self._cache:
+            cached_raw_idx = np.unique(self._raw_idx)
+            image_bytes = int(np.prod(self._raw_shape[1:]))
+            local_ranks = int(os.environ.get('LOCAL_WORLD_SIZE', 1))  # each local rank builds its own dataset
+            if cache_size is None:
+                cache_size = psutil.virtual_memory().available // 2 // local_ranks // image_bytes
+            # The shared cache lives in /dev/shm (64 MB by default in Docker) and every local rank allocates its
+            # own copy, so it is only used when all of them fit there.
+            shm_free = shutil.disk_usage('/dev/shm').free if os.path.isdir('/dev/shm') else 0
+            shm_needed = local_ranks * cached_raw_idx.size * (image_bytes + 1)
+            if cache_size >= cached_raw_idx.size and shm_needed <= shm_free:
+                # Allocated straight in shared memory; share_memory_() would first build a private copy. The
+                # segment is reserved in full here and filled as images are decoded.
+                storage = torch.UntypedStorage._new_shared(cached_raw_idx.size * image_bytes)
+                self._cached_images = torch.empty(0, dtype=torch.uint8).set_(storage).view(
+                    cached_raw_idx.size, *self._raw_shape[1:])
+                self._cached_flags = torch.zeros(cached_raw_idx.size, dtype=torch.bool).share_memory_()
+                self._cache_slot = np.full(self._raw_shape[0], -1, dtype=np.int64)
+                self._cache_slot[cached_raw_idx] = np.arange(cached_raw_idx.size)
+            else:
+                self._cache_size = int(cache_size)
+
         # random ---
         # TODO: Should we also do class balanced ?
         # select indices to corrupt
         self.num_corrupted_samples = int(self.corruption_fraction * len(self._raw_idx))
-        self.corrupted_indices = np.random.choice(a=self._raw_idx, size=self.num_corrupted_samples, replace=False)
+        # Seeded like max_size so that every rank and every worker agrees on which images are corrupted.
+        self.corrupted_indices = np.random.RandomState(seed).choice(
+            a=self._raw_idx, size=self.num_corrupted_samples, replace=False)
+        self._corrupted_mask = np.zeros(self._raw_shape[0], dtype=bool)  # O(1) membership test by raw_idx
+        self._corrupted_mask[self.corrupted_indices] = True
 
         # Apply xflip.
         self._xflip = np.zeros(self._raw_idx.size, dtype=np.uint8)
@@ -107,8 +245,34 @@ class Dataset(torch.utils.data.Dataset):
     def _load_raw_labels(self):  # to be overridden by subclass
         raise NotImplementedError
 
+    def _init_process_local(self):
+        if self._local_pid != os.getpid():  # first use in this process, e.g. a freshly started DataLoader worker
+            self._buffer_pool = _BufferPool()
+            self._decode_executor = None
+            self._local_pid = os.getpid()
+
+    def _get_buffer_pool(self):
+        self._init_process_local()
+        return self._buffer_pool
+
+    def _get_decode_executor(self):
+        self._init_process_local()
+        if self._decode_executor is None:
+            self._decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._decode_threads)
+        return self._decode_executor
+
+    def _get_lru_loader(self):
+        if self._lru_loader is None:
+            # Every DataLoader worker holds its own LRU, so each gets an equal share of the rank's budget.
+            worker_info = torch.utils.data.get_worker_info()
+            num_workers = 1 if worker_info is None else worker_info.num_workers
+            maxsize = max(self._cache_size // num_workers, 1)
+            self._lru_loader = functools.lru_cache(maxsize=maxsize)(self._load_raw_image)
+        return self._lru_loader
+
     def __getstate__(self):
-        return dict(self.__dict__, _raw_labels=None)
+        return dict(self.__dict__, _raw_labels=None, _lru_loader=None,
+                    _local_pid=None, _buffer_pool=None, _decode_executor=None)
 
     def __del__(self):
         try:
@@ -120,70 +284,93 @@ class Dataset(torch.utils.data.Dataset):
         return self._raw_idx.size
 
     def __getitem__(self, idx):
-        raw_idx = self._raw_idx[idx]
-        image = self._cached_images.get(raw_idx, None)
-        if image is None:
+        return self._prepare_item(idx, self._get_raw_image(self._raw_idx[idx]))
+
+    def __getitems__(self, indices):
+        # Batched fetch used by DataLoader workers (torch>=2.0). With decode_threads > 1 the batch's images are
+        # decoded on a thread pool, which only pays off if the decoder releases the GIL and the host has cores to
+        # spare beyond the DataLoader workers; the post-processing below stays serial.
+        # Inside a worker the samples go straight to collate_fn, so their image buffers can be recycled.
+        buffer_pool = self._get_buffer_pool() if torch.utils.data.get_worker_info() is not None else None
+        raw_idxs = [self._raw_idx[idx] for idx in indices]
+        if self._decode_threads <= 1 or len(indices) <= 1:
+            images = map(self._get_raw_image, raw_idxs)
+        else:
+            images = self._get_decode_executor().map(self._get_raw_image, raw_idxs)
+        return [self._prepare_item(idx, image, buffer_pool) for idx, image in zip(indices, images)]
+
+    def _get_raw_image(self, raw_idx):
+        if self._cached_images is not None:
+            slot = self._cache_slot[raw_idx]
+            if self._cached_flags[slot]:
+                image = self._cached_images[slot].numpy()
+            else:
+                image = self._load_raw_image(raw_idx)
+                self._cached_images[slot] = torch.from_numpy(image)
+                self._cached_flags[slot] = True  # set only after the image is fully written
+        elif self._cache:
+            image = self._get_lru_loader()(int(raw_idx))
+        else:
             image = self._load_raw_image(raw_idx)
-            if self._cache:
-                self._cached_images[raw_idx] = image
+        return image
+
+    def _prepare_item(self, idx, image, buffer_pool=None):
+        raw_idx = self._raw_idx[idx]
         assert isinstance(image, np.ndarray)
         assert list(image.shape) == self.image_shape
         assert image.dtype == np.uint8
-        if self._xflip[idx]:
-            assert image.ndim == 3  # CHW
-            image = image[:, :, ::-1]
-
-        # with fixed seed for reproducibility
-        np.random.seed(raw_idx)
-        torch.manual_seed(raw_idx)
+        assert image.ndim == 3  # CHW
         if self.normalize:
-            image = image.astype(np.float32) / 127.5 - 1
-
-        # Apply Corruption iff it is part of the corrupted indices -
-        # get array that masks each pixel with probability self.corruption_probability
-        corruption_mask, hat_corruption_mask = 1, 1
-        # if raw_idx in self.corrupted_indices:
-        #     # Masking -- Like Daras et.al. Ambient Diffusion
-        if self.corruption_pattern == "dust":
-            if self.mask_full_rgb:
-                corruption_mask = np.random.binomial(1, 1 - self.corruption_probability, size=image.shape[1:]).astype(np.float32)
-                corruption_mask = corruption_mask[np.newaxis, :, :].repeat(image.shape[0], axis=0)
-                extra_mask = np.random.binomial(1, 1 - self.delta_probability, size=image.shape[1:]).astype(
-                    np.float32)
-                extra_mask = extra_mask[np.newaxis, :, :].repeat(image.shape[0], axis=0)
-                hat_corruption_mask = np.minimum(corruption_mask, extra_mask)
+            if buffer_pool is None:
+                out = np.empty(image.shape, dtype=np.float32)
             else:
-                corruption_mask = np.random.binomial(1, 1 - self.corruption_probability, size=image.shape).astype(np.float32)
-                hat_corruption_mask = np.minimum(corruption_mask, np.random.binomial(1, 1 - self.delta_probability, size=image.shape).astype(np.float32))
-
-        elif self.corruption_pattern == "box":
-            corruption_mask = get_box_mask((1,) + image.shape, 1 - self.corruption_probability, same_for_all_batch=False, device='cpu')[0]
-            hat_corruption_mask = get_box_mask((1,) + image.shape, 1 - self.corruption_probability, same_for_all_batch=False, device='cpu')[0]
-            hat_corruption_mask = corruption_mask * hat_corruption_mask
-
-        elif self.corruption_pattern == "fixed_box":
-            patch_size = int(self.corruption_probability * image.shape[-2])
-            corruption_mask = 1 - get_patch_mask((1,) + image.shape, patch_size, same_for_all_batch=False, device='cpu')[0]
-            if self.delta_probability > 0:
-                hat_corruption_mask = 1 - get_patch_mask((1,) + image.shape, patch_size, same_for_all_batch=False, device='cpu')[0]
-                hat_corruption_mask = corruption_mask * hat_corruption_mask
-            else:
-                hat_corruption_mask = corruption_mask
-
-        elif self.corruption_pattern == "keep_patch":
-            patch_size = int((1 - self.corruption_probability) * image.shape[-2])
-            corruption_mask = get_patch_mask((1,) + image.shape, patch_size, same_for_all_batch=False, device='cpu')
-            hat_patch_size = int((1 - self.delta_probability) * patch_size)
-            hat_corruption_mask = get_hat_patch_mask(corruption_mask, patch_size, hat_patch_size, same_for_all_batch=False, device='cpu')[0]
-            corruption_mask = corruption_mask[0]
-
-        # other corruptions
+                out = buffer_pool.get(image.shape, np.float32)
+            _flip_normalize(image, out, bool(self._xflip[idx]))
+            image = out
         else:
-            raise NotImplementedError("Corruption pattern not implemented")
-
-        return image.copy(), self.get_label(idx), corruption_mask, hat_corruption_mask
-
+            image = (image[:, :, ::-1] if self._xflip[idx] else image).copy()  # never hand out the cached buffer
 
+        # Apply Corruption iff it is part of the corrupted indices -
+        # get array that masks each pixel with probability self.corruption_probability
+        # with a generator seeded by raw_idx for reproducibility; uncorrupted samples draw nothing.
+        if self._corrupted_mask[raw_idx]:
+            corruption_mask, hat_corruption_mask = self._apply_corruption(image.shape, np.random.default_rng(raw_idx))
+        else:  # every pixel observed
+            corruption_mask, hat_corruption_mask = np.ones(image.shape, dtype=bool), np.ones(image.shape, dtype=bool)
+
+        # Masks are boolean (True = observed pixel); consumers widen them after the host-to-device copy.
+        return image, self.get_label(idx), corruption_mask, hat_corruption_mask
+
+    # Masking -- Like Daras et.al. Ambient Diffusion. Each method returns (corruption_mask, hat_corruption_mask).
+    def _apply_dust(self, image_shape, rng):
+        mask_shape = image_shape[1:] if self.mask_full_rgb else image_shape
+        corruption_mask = rng.random(mask_shape, dtype=np.float32) >= self.corruption_probability
+        hat_corruption_mask = corruption_mask & (rng.random(mask_shape, dtype=np.float32) >= self.delta_probability)
+        if self.mask_full_rgb:  # same HxW mask for every channel
+            corruption_mask = np.repeat(corruption_mask[np.newaxis], image_shape[0], axis=0)
+            hat_corruption_mask = np.repeat(hat_corruption_mask[np.newaxis], image_shape[0], axis=0)
+        return corruption_mask, hat_corruption_mask
+
+    def _apply_box(self, image_shape, rng):
+        # Both boxes come from one call; the hat mask is combined in place.
+        masks = get_box_mask_np((2,) + image_shape, 1 - self.corruption_probability, rng,
+                                out=np.empty((2,) + image_shape, dtype=bool))
+        masks[1] &= masks[0]
+        return masks[0], masks[1]
+
+    def _apply_fixed_box(self, image_shape, rng):
+        num_masks = 2 if self.delta_probability > 0 else 1
+        masks = get_patch_mask_np((num_masks,) + image_shape, self._patch_size, rng,
+                                  out=np.empty((num_masks,) + image_shape, dtype=bool))
+        np.logical_not(masks, out=masks)
+        masks[-1] &= masks[0]  # no-op when there is a single mask
+        return masks[0], masks[-1]
+
+    def _apply_keep_patch(self, image_shape, rng):
+        masks = get_patch_mask_np((1,) + image_shape, self._patch_size, rng,
+                                  out=np.empty((1,) + image_shape, dtype=bool))
+        hat_corruption_mask = get_hat_patch_mask_np(masks, self._patch_size, self._hat_patch_size, rng)[0]
+        return masks[0], hat_corruption_mask
 
     def get_label(self, idx):
         label = self._get_raw_labels()[self._raw_idx[idx]]
@@ -255,19 +442,24 @@ class ImageFolderDataset(Dataset):
         self._path = path
         self._use_pyspng = use_pyspng
         self._zipfile = None
+        self._zip_mmap = None
+        self._zip_members = None  # {fname: (header_offset, compress_size, compress_type), ...}
 
+        PIL.Image.init()
         if os.path.isdir(self._path):
             self._type = 'dir'
-            self._all_fnames = {os.path.relpath(os.path.join(root, fname), start=self._path) for root, _dirs, files in
-                                os.walk(self._path) for fname in files}
+            self._all_fnames = [os.path.relpath(os.path.join(root, fname), start=self._path) for root, _dirs, files in
+                                os.walk(self._path) for fname in files]
+            self._image_fnames = self._filter_image_fnames(self._all_fnames)
         elif self._file_ext(self._path) == '.zip':
             self._type = 'zip'
-            self._all_fnames = set(self._get_zipfile().namelist())
+            zip_index = self._load_zip_index()
+            self._all_fnames = zip_index['all_fnames']
+            self._image_fnames = zip_index['image_fnames']
+            self._zip_members = zip_index['zip_members']
         else:
             raise IOError('Path must point to a directory or zip')
 
-        PIL.Image.init()
-        self._image_fnames = sorted(fname for fname in self._all_fnames if self._file_ext(fname) in PIL.Image.EXTENSION)
         if len(self._image_fnames) == 0:
             raise IOError('No image files found in the specified path')
 
@@ -281,12 +473,58 @@ class ImageFolderDataset(Dataset):
     def _file_ext(fname):
         return os.path.splitext(fname)[1].lower()
 
+    @staticmethod
+    def _filter_image_fnames(fnames):
+        image_exts = tuple(PIL.Image.EXTENSION)
+        return sorted(fname for fname in fnames if fname.lower().endswith(image_exts))
+
+    def _load_zip_index(self):
+        # Scanning the central directory is O(files), so its result is cached next to the archive,
+        # keyed by a format version and the archive's size and mtime.
+        stat = os.stat(self._path)
+        key = (_ZIP_INDEX_VERSION, os.path.abspath(self._path), stat.st_size, stat.st_mtime_ns)
+        # Plain JSON rather than pickle: the file sits next to the dataset, and loading it must never run code.
+        cache_path = self._path + '.fnames.json'
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                zip_index = json.load(f)
+            if tuple(zip_index['key']) == key:
+                return dict(key=key, all_fnames=[str(fname) for fname in zip_index['all_fnames']],
+                            image_fnames=[str(fname) for fname in zip_index['image_fnames']],
+                            zip_members={str(fname): tuple(int(x) for x in member)
+                                         for fname, member in zip_index['zip_members'].items()})
+        except Exception:
+            pass  # missing, stale or corrupt cache: rescan the archive
+
+        zf = self._get_zipfile()
+        all_fnames = zf.namelist()
+        zip_index = dict(key=key, all_fnames=all_fnames, image_fnames=self._filter_image_fnames(all_fnames),
+                         # Workers read members through these offsets and never re-parse the central directory.
+                         zip_members={info.filename: (info.header_offset, info.compress_size, info.compress_type)
+                                      for info in zf.infolist()
+                                      if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)})
+        try:
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(zip_index, f)
+            os.replace(tmp_path, cache_path)  # atomic, several ranks may race to write the cache
+        except OSError:
+            pass  # e.g. read-only dataset location
+        return zip_index
+
     def _get_zipfile(self):
         assert self._type == 'zip'
         if self._zipfile is None:
             self._zipfile = zipfile.ZipFile(self._path)
         return self._zipfile
 
+    def _get_zip_mmap(self):
+        assert self._type == 'zip'
+        if self._zip_mmap is None:
+            with open(self._path, 'rb') as f:
+                self._zip_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._zip_mmap
+
     def _open_file(self, fname):
         if self._type == 'dir':
             return open(os.path.join(self._path, fname), 'rb')
@@ -294,23 +532,46 @@ class ImageFolderDataset(Dataset):
             return self._get_zipfile().open(fname, 'r')
         return None
 
+    def _read_file(self, fname):
+        if self._type == 'zip' and fname in self._zip_members:
+            # Read the member straight from the mapped archive using the offsets from the central directory.
+            header_offset, compress_size, compress_type = self._zip_members[fname]
+            buf = self._get_zip_mmap()
+            name_len, extra_len = struct.unpack('<HH', buf[header_offset + 26:header_offset + 30])
+            data_offset = header_offset + 30 + name_len + extra_len  # skip the local file header
+            data = buf[data_offset:data_offset + compress_size]
+            if compress_type == zipfile.ZIP_DEFLATED:
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+            return data
+        with self._open_file(fname) as f:
+            return f.read()
+
     def close(self):
         try:
             if self._zipfile is not None:
                 self._zipfile.close()
+            if self._zip_mmap is not None:
+                self._zip_mmap.close()
         finally:
             self._zipfile = None
+            self._zip_mmap = None
 
     def __getstate__(self):
-        return dict(super().__getstate__(), _zipfile=None)
+        return dict(super().__getstate__(), _zipfile=None, _zip_mmap=None)
 
     def _load_raw_image(self, raw_idx):
         fname = self._image_fnames[raw_idx]
-        with self._open_file(fname) as f:
-            if self._use_pyspng and pyspng is not None and self._file_ext(fname) == '.png':
-                image = pyspng.load(f.read())
-            else:
-                image = np.array(PIL.Image.open(f))
+        ext = self._file_ext(fname)
+        data = self._read_file(fname)  # one read instead of the decoder's small chunked reads
+        image = None
+        if ext == '.png' and self._use_pyspng and pyspng is not None:
+            image = pyspng.load(data)
+        elif ext in ('.jpg', '.jpeg') and simplejpeg is not None:
+            jpeg_colorspace = simplejpeg.decode_jpeg_header(data)[2]
+            if jpeg_colorspace in ('Gray', 'YCbCr'):  # leave CMYK/YCCK to Pillow
+                image = simplejpeg.decode_jpeg(data, colorspace='GRAY' if jpeg_colorspace == 'Gray' else 'RGB')
+        if image is None:
+            image = np.array(PIL.Image.open(io.BytesIO(data)))
         if image.ndim == 2:
             image = image[:, :, np.newaxis]  # HW => HWC
         image = image.transpose(2, 0, 1)  # HWC => CHW
@@ -320,12 +581,11 @@ class ImageFolderDataset(Dataset):
         fname = 'dataset.json'
         if fname not in self._all_fnames:
             return None
-        with self._open_file(fname) as f:
-            labels = json.load(f)['labels']
+        labels = json.loads(self._read_file(fname))['labels']  # served from the zip mmap, no ZipFile per worker
         if labels is None:
             return None
         labels = dict(labels)
         labels = [labels[fname.replace('\\', '/')] for fname in self._image_fnames]
-        labels = np.array(labels)
-        labels = labels.astype({1: np.int64, 2: np.float32}[labels.ndim])
-        return labels
+        if isinstance(labels[0], (list, tuple)):
+            return np.array(labels, dtype=np.float32)
+        return np.fromiter(labels, dtype=np.int64, count=len(labels))  # class indices, no intermediate array
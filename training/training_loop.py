@@ -19,6 +19,7 @@ import dnnlib
 from torch_utils import distributed as dist
 from torch_utils import training_stats
 from torch_utils import misc
+from training.dataset import collate_channels_last
 import wandb
 
 
@@ -48,6 +49,7 @@ def training_loop(
 		cudnn_benchmark=True,  # Enable torch.backends.cudnn.benchmark?
 		device=torch.device('cuda'),
 		max_grad_norm=None,  # gradient clipping.
+		channels_last=False,  # Feed NHWC (channels_last) batches and weights to the network?
 ):
 	# Initialize.
 	start_time = time.time()
@@ -71,6 +73,8 @@ def training_loop(
 	dataset_obj = dnnlib.util.construct_class_by_name(**dataset_kwargs)  # subclass of training.dataset.Dataset
 	dataset_sampler = misc.InfiniteSampler(dataset=dataset_obj, rank=dist.get_rank(),
 	                                       num_replicas=dist.get_world_size(), seed=seed)
+	if channels_last:
+		data_loader_kwargs = dict(data_loader_kwargs, collate_fn=collate_channels_last)
 	dataset_iterator = iter(
 		torch.utils.data.DataLoader(dataset=dataset_obj, sampler=dataset_sampler, batch_size=batch_gpu,
 		                            **data_loader_kwargs))
@@ -82,6 +86,8 @@ def training_loop(
 	net = dnnlib.util.construct_class_by_name(**network_kwargs, **interface_kwargs)  # subclass of torch.nn.Module
 
 	net.train().requires_grad_(True).to(device)
+	if channels_last:
+		net.to(memory_format=torch.channels_last)
 	with torch.no_grad():
 		images = torch.zeros([batch_gpu, net.img_channels, net.img_resolution, net.img_resolution], device=device)
 		sigma = torch.ones([batch_gpu], device=device)
@@ -145,12 +151,14 @@ def training_loop(
 					hat_corruption_matrix = None
 				elif len(dataset_iter) == 4:
 					images, labels, corruption_matrix, hat_corruption_matrix = dataset_iter
-					corruption_matrix = corruption_matrix.to(device)
-					hat_corruption_matrix = hat_corruption_matrix.to(device)
+					# Masks are shipped as bool and only widened on the GPU.
+					corruption_matrix = corruption_matrix.to(device, non_blocking=True).to(torch.float32)
+					hat_corruption_matrix = hat_corruption_matrix.to(device, non_blocking=True).to(torch.float32)
 				else:
 					raise ValueError(f"Invalid dataset iterator length: {len(dataset_iter)}")
-				images = images.to(device).to(torch.float32)
-				labels = labels.to(device)
+				# Batches come from pinned memory (pin_memory=True), so the copies can overlap with compute.
+				images = images.to(device, non_blocking=True).to(torch.float32)
+				labels = labels.to(device, non_blocking=True)
 
 				train_loss, val_loss, test_loss = loss_fn(net=ddp, images=images, labels=labels,
 				                                          augment_pipe=augment_pipe,